@@ -1,26 +1,97 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
+import pandas as pd # ships with streamlit
 import os
+import sys
+import io
 import subprocess
 import shutil
 import shlex
+import re
+import string
+import fnmatch
+import stat
+import queue
+import threading
+import time
+import datetime
+import json
+import multiprocessing
+import hashlib
 from pathlib import Path
 import logging
-from typing import Tuple, Optional
+from typing import Tuple, Optional, NamedTuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
 # Import Google AI SDK
 import google.generativeai as genai
+try: from google.generativeai import caching as genai_caching # explicit context caching (SDK >= 0.7)
+except ImportError: genai_caching = None
+# Optional local PDF backend
+try: import pymupdf4llm
+except ImportError: pymupdf4llm = None
+# Optional in-process LlamaParse client (same cloud service as the CLI, without a process per PDF)
+try: from llama_cloud_services import LlamaParse
+except ImportError: LlamaParse = None
+# Optional fast hashing for the parse manifest (falls back to hashlib)
+try: import xxhash
+except ImportError: xxhash = None
+# Optional in-process files-to-prompt (same package as the CLI): opt-in, or used when the CLI is not on PATH
+try: from files_to_prompt.cli import cli as f2p_cli
+except ImportError: f2p_cli = None
 
 # --- Configuration ---
 DEFAULT_PDF_INPUT_DIR = "pdfs_to_parse"
 DEFAULT_TXT_INPUT_DIR = "txt_files"
 DEFAULT_PARSED_PDF_OUTPUT_SUBDIR = "parsed_pdfs_streamlit"
 LLAMA_PARSE_COMMAND = "llama-parse"
+LLAMA_PARSE_CMD_PREFIX = (LLAMA_PARSE_COMMAND, "parse")
+LLAMA_PARSE_CMD_SUFFIX = ("--format", "markdown")
 FILES_TO_PROMPT_COMMAND = "files-to-prompt"
 LLAMA_PARSE_CONFIG_FILE = os.path.expanduser("~/.llama-parse/config.json")
 README_FILE = "README.md"
+DEFAULT_PARSE_WORKERS = min(os.cpu_count() or 4, 4)
+MAX_PARSE_WORKERS = 16 # llama-parse is network-bound, so the cap is not tied to CPU count
+LOCAL_PARSE_WORKERS = os.cpu_count() or 1 # PyMuPDF4LLM is CPU-bound: one process per core at most
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # 1 MiB copy chunks for uploads
+UPLOAD_WORKERS = 8
+BULK_DELETE_WORKERS = 8
+PREVIEW_EDGE_BYTES = 32 * 1024 # Session keeps at most head+tail of this size; the full context stays on disk
+STDOUT_CHUNK_SIZE = 64 * 1024
+PARSE_CACHE_DIR = Path("~/.llm-context-gen/parse_cache").expanduser() # Content-addressed parse outputs shared across folders/runs
+PARSE_CACHE_MAX_BYTES = 1 << 30 # Oldest-used entries are evicted beyond this
+PARSE_LOG_FLUSH_EVERY = 10 # parse_pdfs re-renders its log every N completed PDFs, not per PDF
+PARSE_LOG_TAIL_LINES = 50
+PARSE_MANIFEST_FILE = ".manifest.json" # Hidden, so files-to-prompt skips it when combining
+PDF_BACKEND_LLAMA = "llama-parse (cloud)"
+PDF_BACKEND_LOCAL = "PyMuPDF4LLM (local)"
+PDF_BACKEND_SDK = "LlamaParse SDK (cloud, in-process)"
 
 # --- Gemini Configuration ---
 MODEL_NAME = "gemini-2.5-pro-exp-03-25" # Using requested model (verified as existing on 2025-03-27)
+DEFAULT_META_CONTEXT_TOKENS = 32_000 # Context budget sent to Gemini; the meta-prompt only needs the corpus' structure
+MAX_META_CONTEXT_TOKENS = 1_000_000
+CHARS_PER_TOKEN = 4 # Rough estimate for sizing the budget in bytes without a count_tokens round trip
+CONTEXT_SAMPLES = 16 # Evenly spaced middle samples when the context is over budget
+GEMINI_GENERATION_CONFIG = genai.types.GenerationConfig(temperature=0.5)
+GEMINI_SAFETY_SETTINGS = {'HATE': 'BLOCK_ONLY_HIGH'}
+GEMINI_BATCH_WORKERS = 4 # Concurrent requests when several meta-prompt variants are suggested at once
+POOL_WORKERS = {"io": max(UPLOAD_WORKERS, BULK_DELETE_WORKERS), "parse": MAX_PARSE_WORKERS, "gemini": MAX_PARSE_WORKERS} # one executor per workload
+META_PROMPT_SEPARATOR_RE = re.compile(r"^---[ \t]*$", re.MULTILINE)
+CONTEXT_CACHE_MIN_TOKENS = 4_096 # Below this (estimated) the context is sent inline; Gemini 2.5 Pro's minimum cache size
+CONTEXT_CACHE_TTL_S = 3600
+CONTEXT_CACHE_RETRY_S = 300 # after a failed create, send this context inline for a while instead of re-uploading it
+CACHED_CONTEXT_REF = "[The context is provided above as cached content.]" # Stands in for {context_snippet} when cached
+SUMMARY_MODEL_NAME = "gemini-2.5-flash" # Cheap model for the optional map step over very large contexts
+SUMMARY_CHUNK_BYTES = 50 * 1024
+MAX_SUMMARY_CHUNKS = 64 # Chunks grow beyond SUMMARY_CHUNK_BYTES rather than exceed this many calls
+DOCUMENT_END_TAG = b"</document>"
+DOCUMENT_START_RE = re.compile(rb"<document(?:\s[^>]*)?>") # files-to-prompt --cxml; not <documents>/<document_content>
+DOCUMENT_TAG_OVERLAP = 256 # bytes carried between scan blocks so a tag split across them is still found
+MIN_DOC_EXCERPT_BYTES = 512 # below this per document, sample fewer documents instead
+CHUNK_SUMMARY_PROMPT = "List the primary domains/technologies in this snippet in at most 3 bullets. Output only the bullets.\n\n{chunk}"
+PROMPT_CACHE_DIR = Path("~/.llm-context-gen/prompt_cache").expanduser() # Generated prompts keyed by blake2b(meta-prompt + model)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
@@ -52,155 +123,759 @@ def display_error(message): st.toast(f"❌ Error: {message}", icon="❌")
 def display_success(message): st.toast(f"✅ Success: {message}", icon="✅")
 def display_warning(message): st.toast(f"⚠️ Warning: {message}", icon="⚠️")
 def display_info(message): st.toast(f"ℹ️ Info: {message}", icon="ℹ️")
-def check_command(cmd): return shutil.which(cmd) is not None or st.warning(f"'{cmd}' not found.", icon="⚠️") is None
+@st.cache_data(ttl=60, show_spinner=False)
+def _which(cmd) -> Optional[str]: return shutil.which(cmd)
+@st.cache_data(ttl=60, show_spinner=False)
+def _auth_exists() -> bool: return os.path.exists(LLAMA_PARSE_CONFIG_FILE)
+def cancel_parse():
+    """Cancel-button callback. The click's full-app rerun preempts generate_context (it never runs inside a fragment),
+    and closing parse_pdfs' job iterator drops queued jobs and kills running llama-parse children. Callbacks run at
+    the start of that rerun, so `parse_running` still being set means the parse really stopped early."""
+    if st.session_state.pop("parse_running", False): st.session_state.parse_cancelled = True
+def recheck_tools():
+    """Sidebar callback: drop cached tool/auth lookups so the next run re-probes PATH and the config file."""
+    _which.clear(); _auth_exists.clear()
+def check_command(cmd): return _which(cmd) is not None or st.warning(f"'{cmd}' not found.", icon="⚠️") is None
 def check_llama_parse_auth():
-    if not os.path.exists(LLAMA_PARSE_CONFIG_FILE): st.error(f"**Auth Missing:** Config (`{LLAMA_PARSE_CONFIG_FILE}`) missing...", icon="🔑"); return False
+    if not _auth_exists(): st.error(f"**Auth Missing:** Config (`{LLAMA_PARSE_CONFIG_FILE}`) missing...", icon="🔑"); return False
     return True
-def list_files(directory, pattern="*.*"):
+def _is_upload_part(name): return name.startswith(".") and name.endswith(".part")
+def _compile_pattern(pattern): return re.compile(fnmatch.translate(pattern)).match # re.compile keeps its own bounded cache
+@st.cache_data(ttl=5, show_spinner=False)
+def _scan_dir(directory, pattern, mtime, with_sizes=False, by_inode=False):
+    """Cached directory listing; `mtime` is only part of the cache key so adds/deletes invalidate it.
+    `with_sizes` returns (Path, size) pairs (one stat per file, only for the file tables). Sorted by name, or by
+    inode with `by_inode` (roughly on-disk order, so bulk reads of every file seek less). In-progress upload temp files
+    (`.<name>.part`, see _save_upload) are never listed."""
+    match = None if pattern == "*" else _compile_pattern(pattern) # "*" matches every name; skip the regex
+    with os.scandir(directory) as it: # DirEntry.is_file() uses readdir's d_type; no per-entry stat
+        entries=[e for e in it if (match is None or match(e.name)) and not _is_upload_part(e.name) and e.is_file()]
+    entries.sort(key=(lambda e: e.inode()) if by_inode else (lambda e: e.name)) # inode() comes from readdir on POSIX
+    if with_sizes: return [(Path(e.path), e.stat().st_size) for e in entries]
+    return [Path(e.path) for e in entries]
+def list_files(directory, pattern="*", with_sizes=False, by_inode=False):
     if not directory: return []
-    dp=Path(directory);
-    if not dp.is_dir(): return []
-    try: return sorted([f for f in dp.glob(pattern) if f.is_file()])
+    dp=Path(directory)
+    try: ds=dp.stat() # one stat serves both the is-dir check and the cache key
+    except OSError: return []
+    if not stat.S_ISDIR(ds.st_mode): return []
+    try: return _scan_dir(str(dp), pattern, ds.st_mtime_ns, with_sizes, by_inode)
     except Exception as e: display_error(f"List files error '{directory}': {e}"); return []
+@st.cache_resource(show_spinner=False)
+def _pool(kind="io") -> ThreadPoolExecutor:
+    """One executor per workload kind (POOL_WORKERS), shared by all reruns/sessions; callers cap their own concurrency
+    via _bounded_map. Separate pools keep long parse/Gemini jobs from queueing short uploads and deletes behind them."""
+    return ThreadPoolExecutor(max_workers=POOL_WORKERS[kind], thread_name_prefix=f"llmctx-{kind}")
+def _bounded_map(fn, arg_tuples, limit, on_idle=None, idle_interval=0.5, pool="io"):
+    """Submits fn(*args) to the `pool` executor (a POOL_WORKERS kind, or an executor instance) with at most `limit` in flight; yields (args, future) as each completes.
+    Tasks must not touch st.*; results are reduced on the script thread. `on_idle()` runs on the script thread
+    every `idle_interval`s while nothing has finished (for live status; its st.* calls also let a rerun/stop interrupt
+    the wait). Closing the generator submits nothing more and cancels futures that have not started."""
+    pending={}; it=iter(arg_tuples); limit=max(1, int(limit)); executor=_pool(pool) if isinstance(pool, str) else pool
+    def fill():
+        for args in it:
+            pending[executor.submit(fn, *args)]=args
+            if len(pending) >= limit: return
+    try:
+        fill()
+        while pending:
+            done, _ = wait(pending, timeout=idle_interval if on_idle else None, return_when=FIRST_COMPLETED)
+            if not done: on_idle(); continue
+            for fut in done: yield pending.pop(fut), fut
+            fill()
+    finally:
+        for fut in pending: fut.cancel() # queued behind other sessions' jobs; running ones can't be interrupted here
+def _same_content(f, dest):
+    """True if `dest` already holds exactly the upload's bytes (size check first; contents compared only on a size match)."""
+    try:
+        if dest.stat().st_size != getattr(f, "size", -1): return False
+        with dest.open("rb") as cur:
+            f.seek(0)
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                if cur.read(len(chunk)) != chunk: return False
+        return True
+    except OSError: return False
+    finally: f.seek(0)
+def _save_upload(f, dest):
+    """Copies one uploaded file to `dest` (worker thread; no st.* calls); returns False if `dest` was already identical.
+    Writes to a hidden `.<name>.part` in UPLOAD_CHUNK_SIZE chunks and os.replace()s it, so an interrupted upload never
+    leaves a truncated file to parse."""
+    if _same_content(f, dest): return False
+    tmp=dest.with_name(f".{dest.name}.part"); f.seek(0)
+    try:
+        with tmp.open("wb", buffering=0) as out: shutil.copyfileobj(f, out, length=UPLOAD_CHUNK_SIZE) # chunks already 1 MiB; skip BufferedWriter
+        os.replace(tmp, dest); return True
+    except BaseException: tmp.unlink(missing_ok=True); raise
+    finally: f.seek(0) # leave the UploadedFile readable for later callers
 def handle_upload(up_files, target_dir):
     if not up_files or not target_dir: return 0
-    saved=0; skipped=0; tp=Path(target_dir)
+    saved=0; skipped=0; unchanged=0; tp=Path(target_dir)
     try:
         tp.mkdir(parents=True, exist_ok=True)
-        for f in up_files:
-            dest=tp/f.name;
-            if dest.exists(): display_warning(f"Overwriting: '{f.name}'")
-            try: dest.write_bytes(f.getbuffer()); saved+=1
+        existed={f.name for f in up_files if (tp/f.name).exists()}
+        # Writes overlap in worker threads; toasts stay on the script thread.
+        for (f, _), fut in _bounded_map(_save_upload, [(f, tp/f.name) for f in up_files], UPLOAD_WORKERS):
+            try:
+                if not fut.result(): unchanged+=1; continue
+                saved+=1
+                if f.name in existed: display_warning(f"Overwrote: '{f.name}'")
             except Exception as e: display_error(f"Save failed '{f.name}': {e}"); skipped+=1
-        if saved > 0: display_success(f"Processed {saved} uploaded file(s).")
+        if saved > 0: _scan_dir.clear(); display_success(f"Processed {saved} uploaded file(s).")
+        if unchanged > 0: display_info(f"{unchanged} file(s) already up to date; not rewritten.")
         if skipped > 0: display_error(f"Failed {skipped} upload(s).")
     except Exception as e: display_error(f"Upload error: {e}")
     return saved
-def delete_file(fp_str):
+def delete_selected(editor_key, ver_key, paths):
+    """Delete-button callback for file_table: removes rows ticked in the data editor, then resets its selection."""
+    edits=st.session_state.get(editor_key, {}).get("edited_rows", {})
+    bulk_delete([paths[int(i)] for i, change in edits.items() if change.get("Delete")])
+    st.session_state[ver_key]=st.session_state.get(ver_key, 0) + 1
+def bulk_delete(paths):
+    """Unlinks `paths` concurrently on the I/O pool; one cache clear and one summary toast for the batch."""
+    if not paths: return
+    failed=[]
+    for (fp,), fut in _bounded_map(os.unlink, [(fp,) for fp in paths], BULK_DELETE_WORKERS):
+        try: fut.result()
+        except OSError as e: failed.append(f"'{Path(fp).name}': {e}")
+    _scan_dir.clear()
+    if len(failed) < len(paths): display_success(f"Deleted {len(paths) - len(failed)} file(s).")
+    if failed: display_error(f"Delete failed for {len(failed)} file(s): {'; '.join(failed[:3])}")
+def _clear_files(dp, pattern="*"):
+    """Unlinks files matching `pattern` in `dp` (created if missing), keeping the directory inode. Returns count removed.
+    Same entries as _scan_dir lists: symlinks to files count as files, and unlinking one removes the link, not its target."""
+    dp.mkdir(parents=True, exist_ok=True); removed=0; match=_compile_pattern(pattern)
+    with os.scandir(dp) as it: # one readdir pass; d_type avoids a stat per entry
+        for e in it:
+            if match(e.name) and e.is_file(): os.unlink(e.path); removed+=1
+    return removed
+def _is_empty_dir(dp):
+    """True only for an existing directory with no entries (reads at most one dirent)."""
     try:
-        if not fp_str: display_warning("Empty path for deletion."); return
-        fp=Path(fp_str);
-        if fp.is_file(): fn=fp.name; fp.unlink(); display_success(f"Deleted '{fn}'. Refreshing..."); st.rerun()
-        else: display_warning(f"Not found: '{fp_str}'")
-    except Exception as e: display_error(f"Delete error '{fp_str}': {e}")
-def clear_directory(dir_str):
+        with os.scandir(dp) as it: return next(it, None) is None
+    except OSError: return False
+def clear_directory(dir_str, full=False):
+    """Empties `dir_str` of files; `full=True` removes the whole tree (subfolders too) and recreates it."""
     dp=Path(dir_str); cleared=False
-    if dp.exists():
+    if _is_empty_dir(dp): return True # common after a previous 'TXT only' run: nothing to unlink/rmtree
+    if full and dp.exists():
         try: shutil.rmtree(dp); dp.mkdir(parents=True, exist_ok=True); display_info(f"Cleared: '{dir_str}'"); cleared=True
         except OSError as e: display_error(f"Failed clear dir '{dir_str}': {e}"); cleared=False
     else:
-        try: dp.mkdir(parents=True, exist_ok=True); cleared=True
-        except OSError as e: display_error(f"Failed create dir '{dir_str}': {e}"); cleared=False
+        try:
+            if _clear_files(dp): display_info(f"Cleared: '{dir_str}'")
+            cleared=True
+        except OSError as e: display_error(f"Failed clear dir '{dir_str}': {e}"); cleared=False
     return cleared
 
 # --- Gemini Interface Function ---
-def generate_expert_system_prompt(full_context: str, meta_prompt_template: str) -> Tuple[Optional[str], Optional[str]]:
-    if not GEMINI_API_KEY: return None, "Config Error: Env var 'GEMINI_API_KEY' not set."
-    if not full_context or not full_context.strip(): return None, "Input Error: Context empty."
-    if not meta_prompt_template or '{context_snippet}' not in meta_prompt_template: return None, "Input Error: Meta-prompt invalid."
-    try: genai.configure(api_key=GEMINI_API_KEY)
-    except Exception as e: logger.error(f"Config SDK error: {e}"); return None, f"API Config Error: {e}"
-    ctx_snippet = full_context.strip(); logger.info(f"Sending context len {len(ctx_snippet)} to Gemini.")
-    try: final_meta_prompt = meta_prompt_template.format(context_snippet=ctx_snippet)
-    except Exception as e: logger.error(f"Format meta-prompt error: {e}"); return None, f"Meta-Prompt Format Error: {e}"
+class GeminiResponseError(Exception):
+    """Gemini answered without usable text (blocked/empty/unexpected); str(e) is the user-facing message."""
+
+def _prompt_key(final_meta_prompt) -> str:
+    """Cache key for a fully formatted meta-prompt (covers context + template) and the model. Accepts the prompt as
+    one string or as its content parts; both hash the same, since the parts are fed to blake2b in order."""
+    h=hashlib.blake2b(digest_size=16)
+    for part in ([final_meta_prompt] if isinstance(final_meta_prompt, str) else final_meta_prompt): h.update(part.encode("utf-8", "surrogatepass"))
+    h.update(b"\0" + MODEL_NAME.encode()); return h.hexdigest()
+
+_FORMATTER = string.Formatter()
+def meta_prompt_parts(tpl: str, ctx_snippet: str) -> list:
+    """`tpl.format(context_snippet=ctx_snippet)` as a list of content parts: the template text around each
+    {context_snippet} and the snippet itself, which is passed through as-is instead of being copied into one
+    large prompt string. Raises like str.format on unknown fields or bad syntax."""
+    parts=[]; text=[]
+    for literal, field, spec, conv in _FORMATTER.parse(tpl):
+        text.append(literal)
+        if field is None: continue
+        if field != "context_snippet": raise KeyError(field)
+        if spec or conv: text.append(_FORMATTER.format_field(_FORMATTER.convert_field(ctx_snippet, conv), spec)); continue
+        if (lit := "".join(text)): parts.append(lit)
+        parts.append(ctx_snippet); text=[]
+    if (lit := "".join(text)): parts.append(lit)
+    return parts
+
+def _read_prompt_cache(key: str) -> Optional[str]:
+    try: return (PROMPT_CACHE_DIR / f"{key}.txt").read_text(encoding="utf-8") or None
+    except OSError: return None
+
+def _write_prompt_cache(key: str, text: str):
+    """Persists a generated prompt atomically so other sessions/restarts reuse it; failures only cost a future API call."""
     try:
-        logger.info(f"Generating prompt using model: {MODEL_NAME}...")
-        model = genai.GenerativeModel(MODEL_NAME)
-        resp = model.generate_content(final_meta_prompt, generation_config=genai.types.GenerationConfig(temperature=0.5), safety_settings={'HATE': 'BLOCK_ONLY_HIGH'})
-        if hasattr(resp, 'text'):
-            gen_prompt = resp.text.strip()
-            if not gen_prompt:
-                 if resp.prompt_feedback.block_reason: reason = resp.prompt_feedback.block_reason.name; logger.warning(f"Blocked: {reason}"); return None, f"Blocked ({reason})."
-                 else: logger.warning("Gen response empty."); return None, "Error: Empty response from AI."
-            logger.info("Generated suggestion."); return gen_prompt, None
-        elif resp.prompt_feedback.block_reason: reason = resp.prompt_feedback.block_reason.name; logger.warning(f"Blocked (no text): {reason}"); return None, f"Blocked ({reason})."
-        else: logger.error(f"Unexpected response: {resp}"); return None, "Error: Unexpected response structure."
+        PROMPT_CACHE_DIR.mkdir(parents=True, exist_ok=True); tmp=PROMPT_CACHE_DIR / f"{key}.tmp"
+        tmp.write_text(text, encoding="utf-8"); tmp.replace(PROMPT_CACHE_DIR / f"{key}.txt")
+    except OSError as e: logger.warning(f"Prompt cache write failed: {e}")
+
+@st.cache_resource(show_spinner=False)
+def _gemini_model(api_key: str, model_name: str):
+    """SDK configured and model constructed once per (key, model) for the whole server, not per click."""
+    genai.configure(api_key=api_key); return genai.GenerativeModel(model_name)
+
+def _call_gemini(model, final_meta_prompt, on_text=None) -> str:
+    """One generate_content call. Raises GeminiResponseError if no usable text comes back. With `on_text`, the response
+    is streamed and `on_text(text so far)` is called per chunk (script thread only); without it there are no st.*
+    calls, so it can run on the pool. `final_meta_prompt` is a string or a list of content parts."""
+    logger.info(f"Generating prompt using model: {MODEL_NAME}...")
+    resp = model.generate_content(final_meta_prompt, generation_config=GEMINI_GENERATION_CONFIG, safety_settings=GEMINI_SAFETY_SETTINGS, stream=on_text is not None)
+    if on_text is not None:
+        parts=[]
+        for chunk in resp:
+            try: parts.append(chunk.text)
+            except ValueError: continue # chunk without text parts (e.g. safety metadata only)
+            on_text("".join(parts))
+    if hasattr(resp, 'text'):
+        gen_prompt = resp.text.strip()
+        if not gen_prompt:
+             if resp.prompt_feedback.block_reason: reason = resp.prompt_feedback.block_reason.name; logger.warning(f"Blocked: {reason}"); raise GeminiResponseError(f"Blocked ({reason}).")
+             else: logger.warning("Gen response empty."); raise GeminiResponseError("Error: Empty response from AI.")
+        logger.info("Generated suggestion."); return gen_prompt
+    elif resp.prompt_feedback.block_reason: reason = resp.prompt_feedback.block_reason.name; logger.warning(f"Blocked (no text): {reason}"); raise GeminiResponseError(f"Blocked ({reason}).")
+    else: logger.error(f"Unexpected response: {resp}"); raise GeminiResponseError("Error: Unexpected response structure.")
+
+@st.cache_resource(show_spinner=False)
+def _context_caches() -> dict:
+    """{context+model hash: (CachedContent or None, expiry epoch)}, shared by all sessions; None marks a failed create."""
+    return {}
+
+@st.cache_resource(show_spinner=False)
+def _context_caches_lock() -> threading.Lock:
+    """Guards _context_caches(); held across a create so concurrent sessions don't upload the same context twice."""
+    return threading.Lock()
+
+def _cached_context_model(model_name: str, ctx_snippet: str):
+    """GenerativeModel bound to a server-side CachedContent holding `ctx_snippet`, created once per context and TTL,
+    so later clicks/variants send only the instructions. None if the context is too small to cache or the SDK/model
+    doesn't support caching (callers then send the context inline)."""
+    if genai_caching is None or len(ctx_snippet) < CONTEXT_CACHE_MIN_TOKENS * CHARS_PER_TOKEN: return None
+    h=hashlib.blake2b(ctx_snippet.encode("utf-8", "surrogatepass"), digest_size=16); h.update(b"\0" + model_name.encode()); key=h.hexdigest()
+    caches=_context_caches()
+    with _context_caches_lock():
+        hit=caches.get(key)
+        if hit is not None and hit[0] is None and hit[1] > time.time(): return None # create failed recently; don't re-upload
+        if hit is None or hit[0] is None or hit[1] - time.time() < 60: # recreate shortly before expiry rather than racing it
+            for k in [k for k, (_, exp) in caches.items() if exp < time.time()]: caches.pop(k, None) # expired server-side already
+            try: cache=genai_caching.CachedContent.create(model=model_name, display_name=f"llmctx-{key[:16]}", contents=[ctx_snippet], ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL_S))
+            except Exception as e:
+                logger.warning(f"Context caching unavailable, sending context inline: {e}")
+                caches[key]=(None, time.time() + CONTEXT_CACHE_RETRY_S); return None
+            caches[key]=hit=(cache, time.time() + CONTEXT_CACHE_TTL_S); logger.info(f"Created Gemini context cache {cache.name}.")
+    return genai.GenerativeModel.from_cached_content(cached_content=hit[0])
+
+def _api_error_message(e: Exception) -> str:
+    if isinstance(e, GeminiResponseError): return str(e)
+    logger.error(f"API call error ('{MODEL_NAME}'): {e}", exc_info=True)
+    err=str(e).lower();
+    if "api key not valid" in err: return "API Error: Invalid Key (check env var)."
+    elif "quota" in err: return "API Error: Quota exceeded."
+    elif "model" in err and ("not found" in err or "permission" in err): return f"API Error: Model '{MODEL_NAME}' not found/denied."
+    else: return f"API Error: {e}"
+
+def split_meta_prompts(text: str) -> list:
+    """Meta-prompt variants in the editor, separated by lines containing only `---`."""
+    return [t.strip() for t in META_PROMPT_SEPARATOR_RE.split(text or "") if t.strip()]
+
+def generate_expert_system_prompts(full_context: str, templates: list, on_text=None) -> list:
+    """(prompt, error) per meta-prompt template, all against the same context. Cached variants come from
+    PROMPT_CACHE_DIR; the rest are sent to Gemini concurrently (at most GEMINI_BATCH_WORKERS in flight),
+    against an explicit context cache when the context is large enough. A single uncached variant is streamed
+    to `on_text(text so far)`."""
+    if not GEMINI_API_KEY: return [(None, "Config Error: Env var 'GEMINI_API_KEY' not set.")] * len(templates)
+    if not full_context or full_context.isspace(): return [(None, "Input Error: Context empty.")] * len(templates)
+    # strip() copies the whole context; only pay for it when there is edge whitespace to remove.
+    ctx_snippet = full_context.strip() if full_context[0].isspace() or full_context[-1].isspace() else full_context
+    results=[None] * len(templates); todo=[]
+    for i, tpl in enumerate(templates):
+        if not tpl or '{context_snippet}' not in tpl: results[i]=(None, "Input Error: Meta-prompt invalid."); continue
+        try: final_meta_prompt = meta_prompt_parts(tpl, ctx_snippet)
+        except Exception as e: logger.error(f"Format meta-prompt error: {e}"); results[i]=(None, f"Meta-Prompt Format Error: {e}"); continue
+        key=_prompt_key(final_meta_prompt)
+        if (cached := _read_prompt_cache(key)): logger.info(f"Prompt cache hit ({key})."); results[i]=(cached, None)
+        else: todo.append((i, key, final_meta_prompt))
+    if not todo: return results
+    try: model=_gemini_model(GEMINI_API_KEY, MODEL_NAME)
     except Exception as e:
-        logger.error(f"API call error ('{MODEL_NAME}'): {e}", exc_info=True)
-        err=str(e).lower();
-        if "api key not valid" in err: return None, "API Error: Invalid Key (check env var)."
-        elif "quota" in err: return None, "API Error: Quota exceeded."
-        elif "model" in err and ("not found" in err or "permission" in err): return None, f"API Error: Model '{MODEL_NAME}' not found/denied."
-        else: return None, f"API Error: {e}"
+        logger.error(f"Config SDK error: {e}")
+        for i, _, _ in todo: results[i]=(None, f"API Config Error: {e}")
+        return results
+    # Large contexts go into one server-side cache shared by every variant; only the instructions are sent per call.
+    if (ctx_model := _cached_context_model(MODEL_NAME, ctx_snippet)):
+        model=ctx_model; todo=[(i, key, meta_prompt_parts(templates[i], CACHED_CONTEXT_REF)) for i, key, _ in todo]
+        logger.info(f"Using cached context ({len(ctx_snippet)} chars) for {len(todo)} variant(s).")
+    else: logger.info(f"Sending context len {len(ctx_snippet)} to Gemini ({len(todo)} variant(s)).")
+    def finish(i, key, get):
+        try: gen_prompt=get()
+        except Exception as e: results[i]=(None, _api_error_message(e)); return
+        _write_prompt_cache(key, gen_prompt); results[i]=(gen_prompt, None)
+    if len(todo) == 1: i, key, final_meta_prompt = todo[0]; finish(i, key, lambda: _call_gemini(model, final_meta_prompt, on_text))
+    else:
+        for (i, key, _), fut in _bounded_map(lambda i, key, final: _call_gemini(model, final), todo, GEMINI_BATCH_WORKERS, pool="gemini"): finish(i, key, fut.result)
+    return results
 
 # --- Core Processing Functions ---
-def parse_pdfs(pdf_in_dir, parsed_out_dir):
-    """Parses PDFs. Clears output dir first."""
-    # ... (remains same) ...
-    st.write(f"Parsing PDFs from: `{pdf_in_dir}` -> `{parsed_out_dir}`")
-    if not check_command(LLAMA_PARSE_COMMAND): return False, 0, 0
-    if not check_llama_parse_auth(): return False, 0, 0
+def _parse_one_pdf(pdf, out_f, live=None, cancel=None):
+    """Runs llama-parse for one PDF (worker thread; no st.* calls). Returns (pdf, returncode, stderr, output_exists).
+    stdout is discarded; the latest stderr line is published to `live[pdf.name]` for the script thread to show,
+    and only a bounded stderr tail is kept (returned on failure). Setting `cancel` kills the child."""
+    cmd=(*LLAMA_PARSE_CMD_PREFIX, str(pdf), "-o", str(out_f), *LLAMA_PARSE_CMD_SUFFIX)
+    on_line=(lambda line: live.__setitem__(pdf.name, line)) if live is not None else None
+    rc, err = run_streaming(cmd, timeout=300, on_line=on_line, cancel=cancel) # inherits os.environ
+    return pdf, rc, err if rc!=0 else "", out_f.exists()
+
+def _file_digest(fp):
+    """Content hash of `fp`, read in UPLOAD_CHUNK_SIZE chunks (xxh3_64 if available, else blake2b-64)."""
+    h=xxhash.xxh3_64() if xxhash else hashlib.blake2b(digest_size=8)
+    with open(fp, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""): h.update(chunk)
+    return h.hexdigest()
+
+def _load_manifest(parsed_out) -> dict:
+    """{pdf name: {"hash", "mtime_ns", "size", "backend"}} for PDFs whose output in `parsed_out` is current; {} if missing/corrupt."""
+    try: return json.loads((parsed_out / PARSE_MANIFEST_FILE).read_text(encoding="utf-8"))
+    except (OSError, ValueError): return {}
+
+def _save_manifest(parsed_out, manifest):
+    """Writes the manifest atomically (temp file + replace)."""
+    tmp=parsed_out / f"{PARSE_MANIFEST_FILE}.tmp"
+    tmp.write_text(json.dumps(manifest, indent=1, sort_keys=True), encoding="utf-8"); tmp.replace(parsed_out / PARSE_MANIFEST_FILE)
+
+def _manifest_entry(pdf, prev):
+    """Manifest entry for `pdf`; reuses `prev`'s hash when size and mtime are unchanged, so unchanged PDFs are not re-read."""
+    ps=pdf.stat()
+    if prev and prev.get("mtime_ns")==ps.st_mtime_ns and prev.get("size")==ps.st_size: return prev
+    return {"hash": _file_digest(pdf), "mtime_ns": ps.st_mtime_ns, "size": ps.st_size}
+
+def _backend_tag(backend) -> str:
+    """Which Markdown flavour `backend` produces; CLI and SDK use the same LlamaParse service."""
+    return "local" if backend == PDF_BACKEND_LOCAL else "llama"
+
+def _parse_cache_path(entry, backend) -> Path:
+    """Cache file for a PDF's parse output: content hash + size, plus the backend (their Markdown differs)."""
+    return PARSE_CACHE_DIR / f"{entry['hash']}-{entry['size']}-{_backend_tag(backend)}.md"
+
+def _restore_from_parse_cache(entry, backend, out_f) -> bool:
+    """Copies a cached parse of this content to `out_f` (and marks the entry recently used); False on a miss."""
+    src=_parse_cache_path(entry, backend)
+    try: shutil.copyfile(src, out_f); os.utime(src)
+    except OSError: return False
+    return True
+
+def _store_in_parse_cache(entry, backend, out_f):
+    """Adds a fresh parse output to the cache atomically; failures only cost a future re-parse."""
+    dest=_parse_cache_path(entry, backend); tmp=dest.with_name(f".{dest.name}.tmp")
+    try: PARSE_CACHE_DIR.mkdir(parents=True, exist_ok=True); shutil.copyfile(out_f, tmp); os.replace(tmp, dest)
+    except OSError as e: tmp.unlink(missing_ok=True); logger.warning(f"Parse cache write failed: {e}")
+
+def _trim_parse_cache(max_bytes=PARSE_CACHE_MAX_BYTES):
+    """Evicts least-recently-used cache entries (by mtime, refreshed on hit) until the cache fits `max_bytes`."""
+    entries=[]
+    try:
+        with os.scandir(PARSE_CACHE_DIR) as it:
+            for e in it:
+                if e.is_file(): es=e.stat(); entries.append((es.st_mtime, es.st_size, e.path))
+    except OSError: return
+    total=sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes: break
+        try: os.unlink(path); total-=size
+        except OSError: pass
+
+def _prune_parsed_dir(parsed_out, keep):
+    """Removes entries in `parsed_out` not named in `keep` (outputs of deleted/renamed PDFs). Returns count removed."""
+    removed=0
+    for entry in list(parsed_out.iterdir()):
+        if entry.name in keep: continue
+        if entry.is_dir() and not entry.is_symlink(): shutil.rmtree(entry)
+        else: entry.unlink()
+        removed+=1
+    return removed
+
+def _iter_llama_parse(todo, outs, workers, on_live=None):
+    """Yields (pdf, out_f, result) as llama-parse jobs finish; result() -> (returncode, stderr, output_exists).
+    `on_live({pdf name: latest stderr line})` is called on the script thread while jobs run. Closing the generator
+    (finished, or the script run stopped/rerun) cancels and kills any llama-parse still running."""
+    live={}; cancel=threading.Event()
+    on_idle=(lambda: on_live(dict(live))) if on_live else None
+    try:
+        jobs=[(pdf, outs[pdf], live, cancel) for pdf in todo]
+        for (pdf, out_f, _, _), fut in _bounded_map(_parse_one_pdf, jobs, workers, on_idle=on_idle, pool="parse"):
+            live.pop(pdf.name, None)
+            yield pdf, out_f, (lambda fut=fut: fut.result()[1:])
+    finally: cancel.set()
+
+@st.cache_resource(show_spinner=False)
+def _llama_sdk_parser():
+    """One LlamaParse client for the server; reads LLAMA_CLOUD_API_KEY from the environment."""
+    return LlamaParse(result_type="markdown")
+
+def _parse_one_pdf_sdk(parser, pdf, out_f):
+    """Parses one PDF with the LlamaParse SDK (worker thread; no st.* calls) and writes the joined page markdown."""
+    docs=parser.load_data(str(pdf))
+    out_f.write_text("\n\n".join(d.text for d in docs), encoding="utf-8"); return 0, "", True
+
+def _iter_sdk_parse(todo, outs, workers, on_live=None):
+    """Yields (pdf, out_f, result) as LlamaParse SDK jobs finish on the parse pool; result() -> (0, "", True) or raises.
+    On cancel no further PDFs are submitted, but uploads already in flight run to completion in the background."""
+    parser=_llama_sdk_parser() # created on the script thread (cache_resource)
+    jobs=[(parser, pdf, outs[pdf]) for pdf in todo]
+    on_idle=(lambda: on_live({})) if on_live else None # no per-file output, but keeps the wait interruptible
+    for (_, pdf, out_f), fut in _bounded_map(_parse_one_pdf_sdk, jobs, workers, on_idle=on_idle, pool="parse"):
+        yield pdf, out_f, fut.result
+
+@st.cache_resource(show_spinner=False)
+def _local_parse_pool() -> ProcessPoolExecutor:
+    """One PyMuPDF4LLM process pool for the server (spawn: forking the multithreaded Streamlit/Tornado process
+    can deadlock the child). Callers cap their own concurrency via _bounded_map."""
+    return ProcessPoolExecutor(max_workers=LOCAL_PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+def _iter_local_parse(todo, outs, workers, on_live=None):
+    """Yields (pdf, out_f, result) as PyMuPDF4LLM conversions finish; result() writes the markdown on the script thread.
+    Submits pymupdf4llm.to_markdown itself: functions defined in this script are not picklable for worker processes.
+    On cancel, queued conversions are dropped; running ones finish in the background (the pool is shared by all
+    sessions) and their results are discarded."""
+    pool=_local_parse_pool(); by_path={str(pdf): pdf for pdf in todo}
+    on_idle=(lambda: on_live({})) if on_live else None # st.* call, so a Cancel click/rerun interrupts the wait
+    for (path,), fut in _bounded_map(pymupdf4llm.to_markdown, [(p,) for p in by_path], workers, on_idle=on_idle, pool=pool):
+        pdf=by_path[path]; out_f=outs[pdf]
+        def result(fut=fut, out_f=out_f):
+            try: md=fut.result()
+            except BrokenProcessPool: _local_parse_pool.clear(); raise # a worker died; the next run gets a fresh pool
+            out_f.write_text(md, encoding="utf-8"); return 0, "", True
+        yield pdf, out_f, result
+
+def parse_pdfs(pdf_in_dir, parsed_out_dir, num_workers=DEFAULT_PARSE_WORKERS, backend=PDF_BACKEND_LLAMA, force=False):
+    """Parses new/changed PDFs in parallel with `backend`. Outputs whose PDF hash matches the manifest are reused
+    (all are re-parsed when `force`); stale outputs are removed."""
+    st.write(f"Parsing PDFs ({backend}) from: `{pdf_in_dir}` -> `{parsed_out_dir}`")
     pdf_in=Path(pdf_in_dir); parsed_out=Path(parsed_out_dir)
     if not pdf_in.is_dir(): display_error(f"PDF Input Dir not found: '{pdf_in_dir}'"); return False, 0, 0
+    pdfs = list_files(pdf_in_dir, "*.pdf", by_inode=True) # hashed and uploaded in this order
+    if not pdfs:
+        # Nothing to parse: skip tool/auth checks and dir setup; only drop outputs left by since-deleted PDFs.
+        try:
+            if parsed_out.is_dir() and (pruned:=_prune_parsed_dir(parsed_out, set())): st.write(f"Removed {pruned} stale parsed file(s).")
+        except OSError as e: display_error(f"Output dir error '{parsed_out_dir}': {e}"); return False, 0, 0
+        st.warning(f"No PDFs found in '{pdf_in_dir}'.", icon="ℹ️"); return True, 0, 0
+    if backend == PDF_BACKEND_LOCAL:
+        if pymupdf4llm is None: display_error("PyMuPDF4LLM not installed (`pip install pymupdf4llm`)."); return False, 0, 0
+    elif backend == PDF_BACKEND_SDK:
+        if LlamaParse is None: display_error("LlamaParse SDK not installed (`pip install llama-cloud-services`)."); return False, 0, 0
+        if not os.environ.get("LLAMA_CLOUD_API_KEY"): display_error("Env var 'LLAMA_CLOUD_API_KEY' not set (needed by the LlamaParse SDK)."); return False, 0, 0
+    else:
+        if not check_command(LLAMA_PARSE_COMMAND): return False, 0, 0
+        if not check_llama_parse_auth(): return False, 0, 0
     st.write(f"Preparing: `{parsed_out_dir}`...")
+    names={pdf: f"{pdf.stem}.md" for pdf in pdfs}; outs={pdf: parsed_out / n for pdf, n in names.items()} # derived once per PDF, reused below
     try:
-        if parsed_out.exists(): shutil.rmtree(parsed_out)
         parsed_out.mkdir(parents=True, exist_ok=True)
+        pruned=_prune_parsed_dir(parsed_out, {*names.values(), PARSE_MANIFEST_FILE})
+        if pruned: st.write(f"Removed {pruned} stale parsed file(s).")
     except OSError as e: display_error(f"Output dir error '{parsed_out_dir}': {e}"); return False, 0, 0
-    pdfs = list_files(pdf_in_dir, "*.pdf")
-    if not pdfs: st.warning(f"No PDFs found in '{pdf_in_dir}'.", icon="ℹ️"); return True, 0, 0
-    st.write(f"Found {len(pdfs)} PDF(s)."); prog = st.progress(0); ok=0; fail=0; env = os.environ.copy()
-    for i, pdf in enumerate(pdfs):
-        pdf_s=str(pdf); base=pdf.stem; out_n=f"{base}.md"; out_f=parsed_out/out_n; out_f_s=str(out_f)
-        st.write(f"Processing '{pdf.name}'...")
-        try:
-            cmd=[LLAMA_PARSE_COMMAND, "parse", pdf_s, "-o", out_f_s, "--format", "markdown"]
-            res=subprocess.run(cmd, capture_output=True, text=True, check=False, env=env, timeout=300)
-            if res.returncode==0 and out_f.exists(): ok+=1; st.write(f"-> Parsed to '{out_n}'")
-            elif res.returncode==0: st.write("-> WARN: Output missing."); fail+=1
-            else:
-                fail+=1; st.write(f"-> ERROR: LlamaParse fail ({res.returncode}) for '{pdf.name}'.")
-                with st.expander("Show Output/Error"):
-                    if res.stdout: st.text_area("Out", res.stdout.strip(), height=100, key=f"out_{pdf.name}")
-                    if res.stderr: st.text_area("Err", res.stderr.strip(), height=100, key=f"err_{pdf.name}")
-        except Exception as e: st.write(f"-> ERROR: {e}"); fail+=1
-        finally: prog.progress((i + 1) / len(pdfs))
-    st.write(f"--- Parsing Summary --- OK: {ok}, Fail: {fail}")
+    # Skip PDFs whose content hash and backend match the manifest and whose output still exists.
+    # An output from the other backend is not current either; it goes through the cache-restore/parse path.
+    manifest={} if force else _load_manifest(parsed_out); entries={}; current={}; todo=[]; tag=_backend_tag(backend)
+    try:
+        for pdf in pdfs:
+            prev=manifest.get(pdf.name); entries[pdf.name]=entry={**_manifest_entry(pdf, prev), "backend": tag}
+            if prev and prev.get("hash")==entry["hash"] and prev.get("backend")==tag and outs[pdf].is_file(): current[pdf.name]=entry
+            else: todo.append(pdf)
+    except OSError as e: display_error(f"PDF read error: {e}"); return False, 0, 0
+    up_to_date=len(current); restored=0
+    if not force: # content seen before (other folder, cleared output, re-added file): reuse its cached parse
+        missing=todo; todo=[]
+        for pdf in missing:
+            if _restore_from_parse_cache(entries[pdf.name], backend, outs[pdf]): current[pdf.name]=entries[pdf.name]; restored+=1
+            else: todo.append(pdf)
+    cached=len(current)
+    st.write(f"Found {len(pdfs)} PDF(s); {up_to_date} up to date, {restored} restored from cache, {len(todo)} to parse.")
+    ok=cached; fail=0
+    if todo:
+        for pdf in todo: outs[pdf].unlink(missing_ok=True) # so a missing output is detected, not masked by an old one
+        workers=max(1, min(int(num_workers or 1), len(todo)))
+        # Workers only parse; all st.* rendering stays on the script thread. Per-file lines go to a local log that is
+        # flushed every PARSE_LOG_FLUSH_EVERY completions, and error expanders are rendered once after the loop.
+        runner={PDF_BACKEND_LOCAL: _iter_local_parse, PDF_BACKEND_SDK: _iter_sdk_parse}.get(backend, _iter_llama_parse)
+        log=[]; failures=[]; parsed=0; st.session_state.parse_running = True # cleared once every job has been reduced
+        with st.status(f"Parsing {len(todo)} PDF(s) with {workers} worker(s)...", expanded=True) as status:
+            cancel_help={PDF_BACKEND_LLAMA: "Stops running parses (llama-parse is killed); PDFs finished so far are kept for the next run.",
+                         PDF_BACKEND_SDK: "Stops submitting PDFs; uploads already sent to LlamaParse finish in the background and are discarded. PDFs finished so far are kept.",
+                         PDF_BACKEND_LOCAL: "Drops queued conversions; running ones finish in the background and are discarded. PDFs finished so far are kept."}
+            st.button("⏹ Cancel parsing", key="cancel_parse", on_click=cancel_parse, help=cancel_help.get(backend))
+            prog=st.progress(0); live_box=st.empty(); log_box=st.empty()
+            on_live=lambda live: live_box.caption(" · ".join(f"`{n}`: {ln[:80]}" for n, ln in live.items()) or "Waiting for parser output...")
+            for done, (pdf, out_f, result) in enumerate(runner(todo, outs, workers, on_live), start=1):
+                try:
+                    rc, err, exists = result()
+                    if rc==0 and exists: parsed+=1; current[pdf.name]=entries[pdf.name]; _store_in_parse_cache(entries[pdf.name], backend, out_f); log.append(f"'{pdf.name}' -> Parsed to '{out_f.name}'")
+                    elif rc==0: log.append(f"'{pdf.name}' -> WARN: Output missing."); fail+=1
+                    else:
+                        fail+=1; log.append(f"-> ERROR: Parse fail ({rc}) for '{pdf.name}'.")
+                        if err: failures.append((pdf.name, err))
+                except Exception as e: log.append(f"'{pdf.name}' -> ERROR: {e}"); fail+=1
+                finally:
+                    prog.progress(done / len(todo), text=f"{done}/{len(todo)} done")
+                    if done % PARSE_LOG_FLUSH_EVERY == 0 or done == len(todo): log_box.code("\n".join(log[-PARSE_LOG_TAIL_LINES:]), language=None)
+            live_box.empty(); st.session_state.parse_running = False
+            status.update(label=f"Parsed {parsed}/{len(todo)} PDF(s)" + (f", {fail} failed" if fail else "") + ".", state="error" if fail else "complete", expanded=bool(fail))
+        ok+=parsed
+        if parsed: _trim_parse_cache()
+        if len(log) > PARSE_LOG_TAIL_LINES: # the live box only kept the tail; one element for the rest
+            with st.expander(f"Full parse log ({len(log)} lines)"): st.code("\n".join(log), language=None)
+        for name, err in failures:
+            with st.expander(f"Show Error: {name}"): st.text_area("Err", err.strip(), height=100, key=f"err_{name}")
+    try: _save_manifest(parsed_out, current)
+    except OSError as e: display_warning(f"Manifest write failed (next run re-parses): {e}")
+    st.write(f"--- Parsing Summary --- OK: {ok} ({cached} cached), Fail: {fail}")
     if fail > 0: display_error(f"{fail} PDF(s) failed."); return False, ok, fail
     elif ok > 0: display_success("PDF parsing complete."); return True, ok, fail
     else:
         if len(pdfs) > 0: display_info("No PDFs parsed.")
         return True, ok, fail
 
-def combine_files_via_cli(dirs_scan, out_fp_s):
-    """Combines files using files-to-prompt (recursive)."""
-    # ... (remains same) ...
+def run_streaming(cmd, timeout, on_line=None, keep_lines=200, stdout_sink=None, cancel=None) -> Tuple[int, str]:
+    """Runs `cmd`, passing each stderr line to `on_line` as it arrives. stdout is discarded, or fed in chunks to
+    `stdout_sink(bytes)` on a reader thread. Returns (returncode, last `keep_lines` of stderr).
+    Raises subprocess.TimeoutExpired, RuntimeError once `cancel` (threading.Event) is set, or the sink's error;
+    the child never outlives the call (a Streamlit rerun/stop interrupting the script also kills it)."""
+    # stdin=DEVNULL: the server's own stdin may be an open pipe, and files-to-prompt reads paths from a non-TTY stdin.
+    proc=subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE if stdout_sink else subprocess.DEVNULL, stderr=subprocess.PIPE)
+    lines=queue.Queue(); tail=deque(maxlen=keep_lines); deadline=time.monotonic() + timeout; sink_err=[]; stop=threading.Event()
+    def pump():
+        for raw in proc.stderr: lines.put(raw)
+        lines.put(None)
+    def drain():
+        try:
+            for chunk in iter(lambda: proc.stdout.read(STDOUT_CHUNK_SIZE), b""):
+                if stop.is_set(): return # call has returned/raised: the caller may already be closing the sink
+                stdout_sink(chunk)
+        except Exception as e: sink_err.append(e); proc.kill()
+    threading.Thread(target=pump, daemon=True).start() # reader thread so the deadline is checked even while the child is silent
+    drainer=threading.Thread(target=drain, daemon=True) if stdout_sink else None
+    if drainer: drainer.start()
+    try:
+        while True:
+            if cancel is not None and cancel.is_set(): raise RuntimeError("Cancelled")
+            if time.monotonic() > deadline: raise subprocess.TimeoutExpired(cmd, timeout) # also for a child that never stops writing
+            try: raw=lines.get(timeout=0.5)
+            except queue.Empty: continue
+            if raw is None: break
+            line=raw.decode("utf-8", "replace").rstrip(); tail.append(line)
+            if on_line and line: on_line(line)
+        rc=proc.wait(timeout=max(0, deadline - time.monotonic()))
+        if drainer:
+            drainer.join(timeout=max(0, deadline - time.monotonic()))
+            if drainer.is_alive(): raise subprocess.TimeoutExpired(cmd, timeout) # sink still being written; callers must not use it
+        if sink_err: raise sink_err[0]
+        return rc, "\n".join(tail)
+    finally:
+        stop.set()
+        if proc.poll() is None: proc.kill(); proc.wait()
+
+class ContextTee:
+    """stdout sink for files-to-prompt: writes every chunk to the output file and keeps only what the preview needs
+    (the first 2*PREVIEW_EDGE_BYTES, plus the last PREVIEW_EDGE_BYTES), so the file is never read back."""
+    def __init__(self, fp): self.f=open(fp, "wb"); self.head=bytearray(); self.tail=bytearray(); self.size=0
+    def __call__(self, chunk):
+        self.f.write(chunk); self.size+=len(chunk)
+        if len(self.head) < 2 * PREVIEW_EDGE_BYTES: self.head+=chunk[:2 * PREVIEW_EDGE_BYTES - len(self.head)]
+        self.tail+=chunk
+        if len(self.tail) > PREVIEW_EDGE_BYTES: del self.tail[:-PREVIEW_EDGE_BYTES]
+    def close(self): self.f.close()
+    @classmethod
+    def from_file(cls, fp):
+        """Preview-only instance built from an existing output file (reads just the head and tail, via seek)."""
+        tee=cls.__new__(cls)
+        with open(fp, "rb") as f:
+            tee.size=os.fstat(f.fileno()).st_size; tee.head=f.read(2 * PREVIEW_EDGE_BYTES)
+            f.seek(max(tee.size - PREVIEW_EDGE_BYTES, 0)); tee.tail=f.read(PREVIEW_EDGE_BYTES)
+        return tee
+    def preview(self) -> Tuple[str, bool]:
+        """Returns (text, truncated), like the preview contract of combine_files_via_cli."""
+        if self.size <= 2 * PREVIEW_EDGE_BYTES: return self.head.decode("utf-8"), False
+        head=self.head[:PREVIEW_EDGE_BYTES].decode("utf-8", errors="ignore"); tail=self.tail.decode("utf-8", errors="ignore")
+        omitted=self.size - 2 * PREVIEW_EDGE_BYTES
+        return f"{head}\n\n... [{omitted:,} bytes omitted from preview - download for the full context] ...\n\n{tail}", True
+
+def combine_files_via_cli(dirs_scan, out_fp, in_process=False):
+    """Combines files using files-to-prompt (recursive). Returns (ok, preview_text, truncated).
+    Runs the CLI as a subprocess (timeout, live status) unless `in_process` is set or only the Python package is
+    installed; the in-process run has no timeout or progress."""
     st.write(f"Combining via '{FILES_TO_PROMPT_COMMAND}' CLI...")
-    if not check_command(FILES_TO_PROMPT_COMMAND): return False, None
-    if not dirs_scan: display_error("No input dirs."); return False, None
-    valid=[str(d.resolve()) for ds in dirs_scan if (d:=Path(ds)).is_dir() or st.warning(f"Skip invalid dir: '{ds}'")]
-    if not valid: display_error("No valid dirs."); return False, None
-    out_fp=Path(out_fp_s).resolve(); out_dir=out_fp.parent
+    use_in_process=f2p_cli is not None and (in_process or _which(FILES_TO_PROMPT_COMMAND) is None)
+    if not use_in_process and not check_command(FILES_TO_PROMPT_COMMAND): return False, None, False
+    if not dirs_scan: display_error("No input dirs."); return False, None, False
+    # Callers pass paths already resolved by derive_paths; abspath() only joins cwd (no per-parent stat walk like
+    # resolve()) and is skipped for absolute inputs. dict.fromkeys dedupes so a repeated dir isn't scanned twice.
+    valid=list(dict.fromkeys(os.path.normpath(ds if os.path.isabs(ds) else os.path.abspath(ds))
+                             for ds in map(str, dirs_scan) if os.path.isdir(ds) or st.warning(f"Skip invalid dir: '{ds}'")))
+    if not valid: display_error("No valid dirs."); return False, None, False
+    out_fp=Path(out_fp).absolute(); out_dir=out_fp.parent # no-op for the resolved Path callers pass
     try: out_dir.mkdir(parents=True, exist_ok=True)
-    except OSError as e: display_error(f"Output dir error '{out_dir}': {e}"); return False, None
-    quoted_out=shlex.quote(str(out_fp))
-    cmd=[FILES_TO_PROMPT_COMMAND] + [shlex.quote(d) for d in valid] + ["--cxml", "-o", quoted_out]
-    st.info(f"Combining: `{', '.join(valid)}` (Recursive)"); st.write(f"Exec: `{' '.join(cmd)}`")
+    except OSError as e: display_error(f"Output dir error '{out_dir}': {e}"); return False, None, False
+    # List argv, no shell: args are passed verbatim, so only the displayed string is shell-quoted.
+    # No -o: stdout is teed to out_fp in one pass, so the output is never read back for the preview.
+    cmd=[FILES_TO_PROMPT_COMMAND, *valid, "--cxml"]
+    st.info(f"Combining: `{', '.join(valid)}` (Recursive)")
+    if use_in_process: return _combine_in_process(valid, out_fp)
+    st.write(f"Exec: `{shlex.join(cmd)} > {shlex.quote(str(out_fp))}`")
     try:
-        res=subprocess.run(cmd, capture_output=True, text=True, check=False, timeout=300)
-        if res.returncode==0 and out_fp.exists():
+        tee=ContextTee(out_fp)
+        try:
+            with st.status(f"Running `{FILES_TO_PROMPT_COMMAND}`...", expanded=False) as status:
+                rc, err = run_streaming(cmd, timeout=300, on_line=lambda line: status.update(label=line[:200]), stdout_sink=tee)
+                status.update(label=f"`{FILES_TO_PROMPT_COMMAND}` exited ({rc}).", state="complete" if rc==0 else "error")
+        finally: tee.close()
+        if rc==0 and out_fp.exists():
             display_success(f"Combined: '{out_fp}'")
-            try: return True, out_fp.read_text(encoding="utf-8")
-            except IOError as e: display_error(f"Read fail '{out_fp}': {e}"); return False, None
-        elif res.returncode==0: display_error(f"Cmd ok, output missing: '{out_fp}'."); return False, None
+            try: preview, truncated = tee.preview(); return True, preview, truncated
+            except ValueError as e: display_error(f"Decode fail '{out_fp}': {e}"); return False, None, False
+        elif rc==0: display_error(f"Cmd ok, output missing: '{out_fp}'."); return False, None, False
         else:
-            display_error(f"'{FILES_TO_PROMPT_COMMAND}' fail ({res.returncode}).")
-            if res.stderr: st.text_area(f"{FILES_TO_PROMPT_COMMAND} Error", res.stderr.strip(), height=100, key="f2p_err")
-            return False, None
-    except Exception as e: display_error(f"Run error '{FILES_TO_PROMPT_COMMAND}': {e}"); return False, None
+            display_error(f"'{FILES_TO_PROMPT_COMMAND}' fail ({rc}).")
+            if err: st.text_area(f"{FILES_TO_PROMPT_COMMAND} Error", err.strip(), height=100, key="f2p_err")
+            return False, None, False
+    except Exception as e: display_error(f"Run error '{FILES_TO_PROMPT_COMMAND}': {e}"); return False, None, False
+
+@st.cache_resource(show_spinner=False)
+def _f2p_lock() -> threading.Lock:
+    """Serializes in-process files-to-prompt runs across sessions: its --cxml document numbering is module state,
+    and each run swaps the process-wide sys.stdin."""
+    return threading.Lock()
+
+def _combine_in_process(valid, out_fp):
+    """files-to-prompt via its Click command in this process, writing straight to `out_fp` (-o) rather than
+    redirecting the shared sys.stdout. One run at a time (_f2p_lock). Same return contract as combine_files_via_cli."""
+    args=[*valid, "--cxml", "-o", str(out_fp)]; st.write(f"Exec (in-process): `{shlex.join([FILES_TO_PROMPT_COMMAND, *args])}`")
+    try:
+        with st.status(f"Running `{FILES_TO_PROMPT_COMMAND}` (in-process)...", expanded=False) as status, _f2p_lock():
+            # files-to-prompt reads extra paths from a non-TTY stdin; the server's stdin (a pipe under systemd/docker)
+            # could block forever or inject paths, so an empty stream stands in for it for the (locked) run.
+            server_stdin, sys.stdin = sys.stdin, io.StringIO()
+            try: f2p_cli.main(args=args, prog_name=FILES_TO_PROMPT_COMMAND, standalone_mode=False)
+            finally: sys.stdin = server_stdin
+            status.update(label=f"`{FILES_TO_PROMPT_COMMAND}` finished.", state="complete")
+        if not out_fp.exists(): display_error(f"Cmd ok, output missing: '{out_fp}'."); return False, None, False
+        preview, truncated = ContextTee.from_file(out_fp).preview()
+    except ValueError as e: display_error(f"Decode fail '{out_fp}': {e}"); return False, None, False
+    except Exception as e: display_error(f"Run error '{FILES_TO_PROMPT_COMMAND}': {e}"); return False, None, False
+    display_success(f"Combined: '{out_fp}'"); return True, preview, truncated
+
+def _document_offsets(f) -> list:
+    """Byte offsets of every `<document ...>` tag in the open context file, scanned in blocks (never fully loaded)."""
+    offs=[]; pos=0; tail=b""; f.seek(0)
+    for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+        data=tail + block; base=pos - len(tail)
+        for m in DOCUMENT_START_RE.finditer(data):
+            if not offs or base + m.start() > offs[-1]: offs.append(base + m.start()) # overlap may re-match the tail
+        pos+=len(block); tail=data[-DOCUMENT_TAG_OVERLAP:]
+    return offs
+
+def load_context_snippet(max_tokens: int) -> str:
+    """Context for Gemini within ~`max_tokens`: the whole file if it fits, else a stratified sample read by byte offset
+    (the file is never fully loaded). With several documents that is the opening of each one (paths + first lines,
+    evenly thinned if there are too many); otherwise the first and last quarter of the budget plus CONTEXT_SAMPLES
+    evenly spaced middle windows."""
+    budget=max(1, int(max_tokens)) * CHARS_PER_TOKEN
+    with open(st.session_state.ctx_path, "rb") as f:
+        size=os.fstat(f.fileno()).st_size
+        if size <= budget: return f.read().decode("utf-8", errors="replace")
+        def chunk(off, n): f.seek(off); return f.read(n).decode("utf-8", errors="ignore")
+        elided=(size - budget) // CHARS_PER_TOKEN
+        if len(offs := _document_offsets(f)) >= 2:
+            n=len(offs); k=min(n, max(2, budget // MIN_DOC_EXCERPT_BYTES))
+            picks=sorted({round(i * (n - 1) / (k - 1)) for i in range(k)}); per=budget // len(picks); ends=offs[1:] + [size]
+            parts=[chunk(offs[j], min(per, ends[j] - offs[j])) for j in picks]
+            logger.info(f"Context {size:,} bytes over budget ~{max_tokens:,} tokens; sending openings of {len(picks)}/{n} documents.")
+            return f"[Excerpt: opening of {len(picks)} of {n} documents; ~{elided:,} tokens elided]\n" + "\n...\n".join(parts)
+        edge=budget // 4; win=max(1, (budget - 2 * edge) // CONTEXT_SAMPLES); step=(size - 2 * edge) / CONTEXT_SAMPLES
+        parts=[chunk(0, edge)]
+        parts+=[chunk(edge + int(i * step + (step - win) / 2), win) for i in range(CONTEXT_SAMPLES)]
+        parts.append(chunk(size - edge, edge))
+    logger.info(f"Context {size:,} bytes over budget ~{max_tokens:,} tokens; sending {len(parts)} excerpts.")
+    return f"\n...[~{elided:,} tokens elided]...\n".join(parts)
+
+def _iter_context_chunks(fp, target_bytes):
+    """Yields the context file as text chunks of ~`target_bytes`, cut after a `</document>` tag where possible
+    (files-to-prompt --cxml), read incrementally so the whole file is never held at once."""
+    buf=bytearray()
+    with open(fp, "rb") as f:
+        for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            buf+=block
+            while len(buf) >= target_bytes:
+                cut=buf.rfind(DOCUMENT_END_TAG, 0, 2 * target_bytes)
+                cut=cut + len(DOCUMENT_END_TAG) if cut > 0 else (target_bytes if len(buf) >= 2 * target_bytes else 0)
+                if not cut: break # no tag yet; read more (cut without one past 2x the target)
+                yield buf[:cut].decode("utf-8", errors="ignore"); del buf[:cut]
+    if buf.strip(): yield buf.decode("utf-8", errors="ignore")
+
+def summarize_context(fp) -> Tuple[Optional[str], Optional[str]]:
+    """Map step for very large contexts: summarizes ~SUMMARY_CHUNK_BYTES chunks concurrently with SUMMARY_MODEL_NAME and
+    returns (joined bullet summaries, error) to use as the meta-prompt's context. Cached on disk by file digest."""
+    if not GEMINI_API_KEY: return None, "Config Error: Env var 'GEMINI_API_KEY' not set."
+    size=os.path.getsize(fp); target=max(SUMMARY_CHUNK_BYTES, -(-size // MAX_SUMMARY_CHUNKS))
+    key="summary-" + _prompt_key(f"{_file_digest(fp)}\0{target}\0{SUMMARY_MODEL_NAME}\0{CHUNK_SUMMARY_PROMPT}")
+    if (cached := _read_prompt_cache(key)): logger.info(f"Summary cache hit ({key})."); return cached, None
+    try: model=_gemini_model(GEMINI_API_KEY, SUMMARY_MODEL_NAME)
+    except Exception as e: logger.error(f"Config SDK error: {e}"); return None, f"API Config Error: {e}"
+    total=-(-size // target); summaries={}; prog=st.progress(0, text=f"Summarizing ~{total} chunk(s) with {SUMMARY_MODEL_NAME}...")
+    jobs=((n, CHUNK_SUMMARY_PROMPT.format(chunk=chunk)) for n, chunk in enumerate(_iter_context_chunks(fp, target)))
+    for (n, _), fut in _bounded_map(lambda n, prompt: _call_gemini(model, prompt), jobs, GEMINI_BATCH_WORKERS, pool="gemini"):
+        try: summaries[n]=fut.result()
+        except Exception as e: prog.empty(); return None, f"Summary of chunk {n + 1} failed: {_api_error_message(e)}"
+        prog.progress(min(len(summaries) / total, 1.0), text=f"Summarized {len(summaries)}/~{total} chunk(s)")
+    prog.empty(); joined="\n".join(summaries[n] for n in sorted(summaries))
+    _write_prompt_cache(key, joined); return joined, None
+
+@st.cache_data(ttl=5, show_spinner=False)
+def ensure_dir(dir_str) -> Tuple[bool, str, Optional[str]]:
+    """Creates `dir_str` if missing. Returns (ok, status label, error). Cached briefly so reruns skip the stat/mkdir calls."""
+    dir_path = Path(dir_str)
+    try:
+        exists = dir_path.is_dir(); dir_path.mkdir(parents=True, exist_ok=True)
+        if exists: return True, "✅ (Exists)", None
+        elif dir_path.is_dir(): return True, "✅ (Created)", None
+        else: return False, "❌", None
+    except OSError as e: return False, "❌ (OS Error)", f"OS Error: {e}"
+    except Exception as e: return False, "❌ (Error)", f"Error: {e}"
 
 # --- Load README ---
-def load_readme():
-    # ... (remains same) ...
-    content = f"Error loading {README_FILE}"; script_d = Path(__file__).parent; p = script_d / README_FILE
-    if not p.exists(): p = Path.cwd() / README_FILE
+@st.cache_data(show_spinner=False)
+def _read_readme(path, mtime):
+    """Cached README text; `mtime` is only part of the cache key so edits invalidate it."""
+    return _read_small_text(path)
+def _read_small_text(path):
+    """UTF-8 text of a small file via one raw fd read sized by fstat (no buffered/TextIOWrapper layer)."""
+    fd=os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
     try:
-        if p.exists(): content = p.read_text(encoding="utf-8")
-        else: content = f"Error: {README_FILE} not found in {script_d} or {Path.cwd()}."
-    except Exception as e: content = f"Error reading {README_FILE}: {e}"
-    return content
+        size=os.fstat(fd).st_size; chunks=[]
+        while size > 0 and (data := os.read(fd, size)): chunks.append(data); size-=len(data)
+    finally: os.close(fd)
+    return b"".join(chunks).decode("utf-8")
+@st.cache_resource(show_spinner=False)
+def _resolve_readme_path() -> Optional[Path]:
+    """Script dir, then cwd; searched once per server process instead of every rerun."""
+    for p in (Path(__file__).parent / README_FILE, Path.cwd() / README_FILE):
+        if p.exists(): return p
+    return None
+def load_readme():
+    p = _resolve_readme_path()
+    if p is None: return f"Error: {README_FILE} not found in {Path(__file__).parent} or {Path.cwd()}."
+    try: return _read_readme(str(p), p.stat().st_mtime_ns) # one stat per rerun keeps edits visible
+    except Exception as e: return f"Error reading {README_FILE}: {e}"
 readme_content = load_readme()
 
+# --- Derived Paths ---
+class AppPaths(NamedTuple):
+    pdf_dir: Path
+    txt_dir: Path
+    parsed_dir: Path
+    output_file: Path
+
+@st.cache_resource(show_spinner=False) # resource (not data): returns the immutable tuple itself, no pickling
+def derive_paths(pdf_dir, txt_dir, out_loc, out_file) -> AppPaths:
+    """Resolves the configured folders once per distinct setting; sidebar and tabs share the resulting Paths,
+    which are passed through to the processing functions as-is."""
+    txt_abs=Path(txt_dir).resolve()
+    return AppPaths(Path(pdf_dir).resolve(), txt_abs, txt_abs / DEFAULT_PARSED_PDF_OUTPUT_SUBDIR, (Path(out_loc) / out_file).resolve())
+
 # --- Upload/Reset Callbacks ---
 def process_pdf_upload():
     uploaded = st.session_state.get("pdf_uploader"); pdf_dir = st.session_state.get("pdf_dir")
@@ -216,12 +891,23 @@ def reset_meta_prompt_callback():
     st.session_state.meta_prompt_template = DEFAULT_META_PROMPT_TEMPLATE
     st.toast("Meta-prompt template reset to default.", icon="🔄")
 
+def clear_prompt_cache_callback():
+    """Drops cached suggestions (PROMPT_CACHE_DIR) so the next click calls Gemini again."""
+    removed=0
+    try:
+        with os.scandir(PROMPT_CACHE_DIR) as it:
+            for e in it:
+                if e.name.endswith(".txt"): os.unlink(e.path); removed+=1
+    except FileNotFoundError: pass
+    except OSError as e: display_error(f"Prompt cache clear failed: {e}"); return
+    st.toast(f"Suggestion cache cleared ({removed} entr{'y' if removed == 1 else 'ies'}).", icon="🧹")
+
 # --- Streamlit App UI ---
 st.set_page_config(layout="wide", page_title="Files-to-Prompt GUI")
 with st.expander("README / Instructions", expanded=False): st.markdown(readme_content, unsafe_allow_html=False)
 st.title("📄 Files-to-Prompt Context Generator")
 st.caption(f"Interface for `{FILES_TO_PROMPT_COMMAND}` & `{LLAMA_PARSE_COMMAND}`.")
-did_llama=check_command(LLAMA_PARSE_COMMAND); did_f2p=check_command(FILES_TO_PROMPT_COMMAND); did_auth=False
+did_llama=check_command(LLAMA_PARSE_COMMAND); did_f2p=f2p_cli is not None or check_command(FILES_TO_PROMPT_COMMAND); did_auth=False
 if did_llama: did_auth = check_llama_parse_auth()
 st.info(f"Checks: `{LLAMA_PARSE_COMMAND}`:{'✅' if did_llama else '❌'}, `{FILES_TO_PROMPT_COMMAND}`:{'✅' if did_f2p else '❌'}, Auth:{'✅' if did_auth else ('❔' if not did_llama else '❌')}", icon="ℹ️")
 
@@ -231,9 +917,19 @@ if 'txt_dir' not in st.session_state: st.session_state.txt_dir=os.path.abspath(D
 if 'out_file' not in st.session_state: st.session_state.out_file="context_prompt_output.txt"
 if 'out_loc' not in st.session_state: st.session_state.out_loc=os.path.abspath(".")
 if 'ctx_content' not in st.session_state: st.session_state.ctx_content = None
+if 'ctx_path' not in st.session_state: st.session_state.ctx_path = None
+if 'ctx_truncated' not in st.session_state: st.session_state.ctx_truncated = False
 if 'suggested_system_prompt' not in st.session_state: st.session_state.suggested_system_prompt = ""
 if 'suggestion_error' not in st.session_state: st.session_state.suggestion_error = None
+if 'suggestion_variants' not in st.session_state: st.session_state.suggestion_variants = []
 if 'meta_prompt_template' not in st.session_state: st.session_state.meta_prompt_template = DEFAULT_META_PROMPT_TEMPLATE
+if 'num_workers' not in st.session_state: st.session_state.num_workers = DEFAULT_PARSE_WORKERS
+if 'pdf_backend' not in st.session_state: st.session_state.pdf_backend = PDF_BACKEND_LLAMA
+if 'deep_clean' not in st.session_state: st.session_state.deep_clean = False
+if 'force_reparse' not in st.session_state: st.session_state.force_reparse = False
+if 'max_context_tokens' not in st.session_state: st.session_state.max_context_tokens = DEFAULT_META_CONTEXT_TOKENS
+if 'summarize_ctx' not in st.session_state: st.session_state.summarize_ctx = False
+if 'f2p_in_process' not in st.session_state: st.session_state.f2p_in_process = False
 
 # --- Sidebar ---
 with st.sidebar:
@@ -242,24 +938,26 @@ with st.sidebar:
     st.text_input("PDF Input Folder", value=st.session_state.pdf_dir, key="pdf_dir", help="Folder for PDFs.")
     st.text_input("TXT Input Folder", value=st.session_state.txt_dir, key="txt_dir", help="Folder for TXT/MD files.")
     st.subheader("Output Settings")
-    parsed_pdf_dir=os.path.join(st.session_state.txt_dir, DEFAULT_PARSED_PDF_OUTPUT_SUBDIR)
-    st.info(f"Parsed PDFs ->\n`{parsed_pdf_dir}`\n(Cleared before parsing)")
     st.text_input("Output Filename", value=st.session_state.out_file, key="out_file", help="Output filename.")
     st.text_input("Output Location", value=st.session_state.out_loc, key="out_loc", help="Output directory.")
-    final_out_path=os.path.abspath(os.path.join(st.session_state.out_loc, st.session_state.out_file))
-    st.info(f"Final context file:\n`{final_out_path}`")
+    paths=derive_paths(st.session_state.pdf_dir, st.session_state.txt_dir, st.session_state.out_loc, st.session_state.out_file)
+    st.info(f"Parsed PDFs ->\n`{paths.parsed_dir}`\n(Only new/changed PDFs re-parsed)")
+    st.subheader("Processing")
+    st.radio("PDF backend", (PDF_BACKEND_LLAMA, PDF_BACKEND_SDK, PDF_BACKEND_LOCAL), key="pdf_backend", help="SDK parsing needs `llama-cloud-services` and `LLAMA_CLOUD_API_KEY`; local parsing needs `pymupdf4llm` (no network or llama-parse auth).")
+    st.number_input("PDF Parse Workers", min_value=1, max_value=MAX_PARSE_WORKERS, value=st.session_state.num_workers, step=1, key="num_workers", help="Parallel parse jobs (local backend is capped at CPU count).")
+    st.info(f"Final context file:\n`{paths.output_file}`")
+    st.checkbox("Force re-parse all PDFs", key="force_reparse", help="Ignore the parse manifest and re-parse every PDF, even unchanged ones.")
+    st.checkbox("Run files-to-prompt in-process", key="f2p_in_process", disabled=f2p_cli is None, help="Skips the subprocess start, but has no timeout or live status; runs are serialized across sessions. Needs the `files-to-prompt` package importable here.")
+    st.checkbox("Deep clean parsed folder", key="deep_clean", help="'TXT only' removes the whole parsed subfolder tree instead of just its files.")
+    st.number_input("Gemini context budget (tokens)", min_value=1_000, max_value=MAX_META_CONTEXT_TOKENS, step=1_000, key="max_context_tokens", help=f"Larger contexts are sampled (head, tail, {CONTEXT_SAMPLES} middle excerpts) before prompt suggestion. Estimated at ~{CHARS_PER_TOKEN} chars/token. Contexts above ~{CONTEXT_CACHE_MIN_TOKENS:,} tokens are cached server-side for {CONTEXT_CACHE_TTL_S // 60} min and shared by all variants.")
+    st.checkbox("Summarize over-budget contexts", key="summarize_ctx", help=f"Instead of sampling, summarize the whole context in chunks with `{SUMMARY_MODEL_NAME}` and suggest from the summaries.")
+    st.button("🔁 Recheck tools", key="recheck_tools", on_click=recheck_tools, help="Re-detect CLI tools and llama-parse auth (cached for 60s).")
     st.markdown("---"); st.subheader("Directory Status")
     dirs_to_ensure = {"PDF Input": st.session_state.pdf_dir, "TXT Input": st.session_state.txt_dir, "Output Location": st.session_state.out_loc,}
     all_dirs_ok = True
     for name, dir_path_str in dirs_to_ensure.items():
-        dir_path = Path(dir_path_str); status_icon = "❔"
-        try:
-            exists = dir_path.is_dir(); dir_path.mkdir(parents=True, exist_ok=True); created = not exists and dir_path.is_dir()
-            if created: status_icon = "✅ (Created)"
-            elif exists: status_icon = "✅ (Exists)"
-            else: status_icon = "❌"; all_dirs_ok = False
-        except OSError as e: status_icon = f"❌ (OS Error)"; all_dirs_ok = False; st.error(f"OS Error: {name}: {e}")
-        except Exception as e: status_icon = f"❌ (Error)"; all_dirs_ok = False; st.error(f"Error: {name}: {e}")
+        ok, status_icon, err = ensure_dir(dir_path_str); all_dirs_ok = all_dirs_ok and ok
+        if err: st.error(f"{err}: {name}")
         st.markdown(f"{status_icon} {name}: `{dir_path_str}`")
 
 # --- Main App Area ---
@@ -269,54 +967,74 @@ if not all_dirs_ok: st.error("Essential directories non-functional. Check sideba
 tab1, tab2, tab3 = st.tabs(["🚀 Process Files", "📤 PDF Upload", "📝 Plaintext Upload"])
 
 # --- Tab 1: Process Files ---
-with tab1:
+@st.fragment
+def process_controls():
+    """Tab 1 header, source choice and Generate button; the radio reruns only this fragment. Generate requests a
+    full-app rerun that runs generate_context outside any fragment, so the Cancel button it shows can preempt it
+    (a click inside a running fragment would wait for the fragment to finish)."""
     st.header("🚀 Process Files")
-    pdf_d=st.session_state.pdf_dir; txt_d=st.session_state.txt_dir
-    parsed_d=os.path.join(txt_d, DEFAULT_PARSED_PDF_OUTPUT_SUBDIR)
-    out_f=os.path.abspath(os.path.join(st.session_state.out_loc, st.session_state.out_file))
-    opt=st.radio("Include:", ("TXT only", "PDF only", "Both"), index=2, key="proc_opt", help="Sources.")
+    if st.session_state.pop("parse_cancelled", False): st.warning("PDF parsing was cancelled; run again to resume (finished PDFs are not re-parsed).")
+    st.radio("Include:", ("TXT only", "PDF only", "Both"), index=2, key="proc_opt", help="Sources.")
     st.write("---")
+    if st.button("Generate Context File", key="generate_main", type="primary"): st.session_state.generate_requested = True; st.rerun()
 
-    if st.button("Generate Context File", key="generate_main", type="primary"):
-        # ... (Processing logic remains same) ...
-        st.session_state.ctx_content = None; st.session_state.suggested_system_prompt = ""; st.session_state.suggestion_error = None
-        parse_ok=True; pdf_successes=0; step_ok=True; target_dir=None
-        if opt in ["PDF only", "Both"]:
-            st.subheader("Step 1: Parsing PDFs")
-            parse_ok, pdf_successes, _ = parse_pdfs(pdf_d, parsed_d)
-            if not parse_ok and opt == "PDF only": st.error("PDF parsing failed..."); st.stop()
-            elif pdf_successes == 0 and opt == "PDF only": st.warning("No PDFs parsed for 'PDF only'."); step_ok = False
-        if step_ok:
-            st.subheader("Step 2: Preparing Combination")
-            if opt == "Both":
-                if Path(txt_d).is_dir(): target_dir=txt_d; st.write(f"Targeting TXT dir (recursive): `{target_dir}`")
-                else: st.error(f"TXT dir invalid ('{txt_d}') for 'Both'."); step_ok=False
-            elif opt == "PDF only":
-                if pdf_successes > 0 and Path(parsed_d).is_dir(): target_dir=parsed_d; st.write(f"Targeting Parsed PDF dir: `{target_dir}`")
-                else: st.warning("No parsed PDFs found for 'PDF only'."); step_ok=False
-            elif opt == "TXT only":
-                if Path(txt_d).is_dir():
-                    st.write("Clearing parsed PDF dir for 'TXT only' mode...")
-                    if clear_directory(parsed_d): target_dir=txt_d; st.write(f"Targeting TXT dir (recursive): `{target_dir}`")
-                    else: st.error("Failed to clear parsed PDF dir."); step_ok=False
-                else: st.error(f"TXT dir invalid ('{txt_d}') for 'TXT only'."); step_ok=False
-            if step_ok and target_dir:
-                st.subheader("Step 3: Combining Files")
-                combine_status, combined_data = combine_files_via_cli([str(target_dir)], str(out_f))
-                if combine_status: st.session_state.ctx_content = combined_data
-                else: st.error("Combination failed.")
-            elif step_ok: st.warning("No target directory for combination.")
+def generate_context(paths):
+    """Parse (optional) + combine for the selected sources; runs on a full-app rerun, not as a fragment."""
+    pdf_d, txt_d, parsed_d, out_f = paths; opt = st.session_state.proc_opt; st.session_state.generate_ran = True
+    st.session_state.ctx_content = None; st.session_state.ctx_path = None; st.session_state.ctx_truncated = False
+    st.session_state.suggested_system_prompt = ""; st.session_state.suggestion_error = None; st.session_state.suggestion_variants = []
+    parse_ok=True; pdf_successes=0; step_ok=True; target_dir=None
+    if opt in ["PDF only", "Both"]:
+        st.subheader("Step 1: Parsing PDFs")
+        parse_ok, pdf_successes, _ = parse_pdfs(pdf_d, parsed_d, st.session_state.num_workers, st.session_state.pdf_backend, st.session_state.force_reparse)
+        if not parse_ok and opt == "PDF only": st.error("PDF parsing failed..."); step_ok = False # not st.stop(): the rest of the page still renders
+        elif pdf_successes == 0 and opt == "PDF only": st.warning("No PDFs parsed for 'PDF only'."); step_ok = False
+    if step_ok:
+        st.subheader("Step 2: Preparing Combination")
+        if opt == "Both":
+            if txt_d.is_dir(): target_dir=txt_d; st.write(f"Targeting TXT dir (recursive): `{target_dir}`")
+            else: st.error(f"TXT dir invalid ('{txt_d}') for 'Both'."); step_ok=False
+        elif opt == "PDF only":
+            if pdf_successes > 0 and parsed_d.is_dir(): target_dir=parsed_d; st.write(f"Targeting Parsed PDF dir: `{target_dir}`")
+            else: st.warning("No parsed PDFs found for 'PDF only'."); step_ok=False
+        elif opt == "TXT only":
+            if txt_d.is_dir():
+                st.write("Clearing parsed PDF dir for 'TXT only' mode...")
+                if clear_directory(parsed_d, full=st.session_state.deep_clean): target_dir=txt_d; st.write(f"Targeting TXT dir (recursive): `{target_dir}`")
+                else: st.error("Failed to clear parsed PDF dir."); step_ok=False
+            else: st.error(f"TXT dir invalid ('{txt_d}') for 'TXT only'."); step_ok=False
+        if step_ok and target_dir:
+            st.subheader("Step 3: Combining Files")
+            combine_status, combined_data, truncated = combine_files_via_cli([target_dir], out_f, st.session_state.f2p_in_process)
+            if combine_status: st.session_state.ctx_content = combined_data; st.session_state.ctx_path = str(out_f); st.session_state.ctx_truncated = truncated
+            else: st.error("Combination failed.")
+        elif step_ok: st.warning("No target directory for combination.")
 
+@st.fragment
+def output_tab(paths):
+    """Tab 1 preview and Gemini suggestion. Its widgets (preview toggles, meta-prompt editing, suggest) rerun only
+    this fragment, so the sidebar checks and the Tab 2/3 listings are not re-executed for them."""
+    out_f = paths.output_file
     # --- Display Output Preview and Gemini Suggestion ---
     st.subheader("Step 4: Output Preview")
     if st.session_state.ctx_content:
         st.success(f"Context generated: `{out_f}`.")
-        st.code(st.session_state.ctx_content, language="markdown", line_numbers=True)
+        # Preview is bounded (<= 2*PREVIEW_EDGE_BYTES plus the omission marker, see ContextTee.preview), so highlighted
+        # st.code stays cheap regardless of context size.
+        preview = st.session_state.ctx_content
+        if st.session_state.ctx_truncated:
+            st.caption(f"Large output: showing first/last {PREVIEW_EDGE_BYTES // 1024} KB only.")
+            # The full file is only read (and shipped to the browser) while this is on, not on every rerun.
+            if st.toggle("Load full context", key="ctx_load_full", help="Enables the download (and optional full preview); re-reads the file on each rerun while on."):
+                full_bytes = Path(st.session_state.ctx_path).read_bytes()
+                st.download_button("⬇️ Download full context", data=full_bytes, file_name=Path(st.session_state.ctx_path).name, key="download_ctx")
+                if st.checkbox("Show full preview", key="ctx_full_preview", help="Renders the whole context; slow for large files."): preview = full_bytes.decode("utf-8", errors="replace")
+        st.code(preview, language="markdown", line_numbers=True)
 
         # --- Gemini Suggestion Section ---
         st.divider()
         st.subheader("🤖 Suggest Expert System Prompt (via Gemini)")
-        st.caption(f"Uses the **full context** above and the `{MODEL_NAME}` model.")
+        st.caption(f"Uses the context above (sampled down to ~{st.session_state.max_context_tokens:,} tokens if larger) and the `{MODEL_NAME}` model.")
 
         with st.expander("⚙️ Edit Meta-Prompt Template for Gemini"):
             st.text_area(
@@ -324,7 +1042,7 @@ with tab1:
                 value=st.session_state.meta_prompt_template, # Reads from state
                 key="meta_prompt_template",                 # Writes to state on edit
                 height=300,
-                help="Edit Gemini instructions. Use {context_snippet} placeholder."
+                help="Edit Gemini instructions. Use {context_snippet} placeholder. Separate variants with a line containing only `---` to compare several at once."
             )
             # Reset button uses callback
             st.button(
@@ -332,56 +1050,80 @@ with tab1:
                 key="reset_meta_prompt",
                 on_click=reset_meta_prompt_callback # Assign callback
             )
+            st.button("Clear Suggestion Cache", key="clear_prompt_cache", on_click=clear_prompt_cache_callback, help=f"Forget cached suggestions (`{PROMPT_CACHE_DIR}`) so identical inputs call Gemini again.")
 
         if st.button("✨ Suggest System Prompt", key="suggest_prompt_btn"):
-            st.session_state.suggested_system_prompt = ""; st.session_state.suggestion_error = None
-            with st.spinner("Generating prompt suggestion... (using full context)"):
+            st.session_state.suggested_system_prompt = ""; st.session_state.suggestion_error = None; st.session_state.suggestion_variants = []
+            with st.spinner("Generating prompt suggestion..."):
                 try:
-                    # Call function defined in this file
-                    gen_prompt, err_msg = generate_expert_system_prompt(
-                        st.session_state.ctx_content,
-                        st.session_state.meta_prompt_template # Pass current (potentially edited) template
-                    )
-                    if err_msg: st.session_state.suggestion_error = err_msg
+                    # One or more variants of the current (potentially edited) template, all on the same context
+                    templates = split_meta_prompts(st.session_state.meta_prompt_template) or [st.session_state.meta_prompt_template]
+                    over_budget = os.path.getsize(st.session_state.ctx_path) > st.session_state.max_context_tokens * CHARS_PER_TOKEN
+                    if st.session_state.summarize_ctx and over_budget: context, err_msg = summarize_context(st.session_state.ctx_path)
+                    else: context, err_msg = load_context_snippet(st.session_state.max_context_tokens), None
+                    stream_box = st.empty() # a single uncached variant streams here as it is generated
+                    results = generate_expert_system_prompts(context, templates, on_text=lambda text: stream_box.code(text, language=None)) if not err_msg else [(None, err_msg)]
+                    stream_box.empty(); gen_prompt, err_msg = results[0]
+                    if len(results) > 1: st.session_state.suggestion_variants = results
+                    elif err_msg: st.session_state.suggestion_error = err_msg
                     elif gen_prompt: st.session_state.suggested_system_prompt = gen_prompt
                     else: st.session_state.suggestion_error = "No prompt or error returned."
                 except Exception as e: st.session_state.suggestion_error = f"Unexpected error: {e}"; st.exception(e)
 
         if st.session_state.suggestion_error: st.error(st.session_state.suggestion_error)
-        st.markdown("**Suggested System Prompt:**")
-        # Display using st.code for copy functionality
-        st.code(st.session_state.suggested_system_prompt, language=None, line_numbers=False)
+        if st.session_state.suggestion_variants:
+            st.markdown("**Suggested System Prompts:**")
+            variants = st.session_state.suggestion_variants
+            for n, (col, (gen_prompt, err_msg)) in enumerate(zip(st.columns(len(variants)), variants), start=1):
+                with col:
+                    st.caption(f"Variant {n}")
+                    if err_msg: st.error(err_msg)
+                    else: st.code(gen_prompt, language=None, line_numbers=False)
+        else:
+            st.markdown("**Suggested System Prompt:**")
+            # Display using st.code for copy functionality
+            st.code(st.session_state.suggested_system_prompt, language=None, line_numbers=False)
         # --- End of Gemini Suggestion Section ---
 
     else:
-         if 'generate_main' in st.session_state and st.session_state.generate_main:
+         if st.session_state.pop("generate_ran", False):
               st.warning("Context generation failed or not yet run.")
+with tab1:
+    process_controls()
+    if st.session_state.pop("generate_requested", False): generate_context(paths)
+    output_tab(paths)
 
 # --- Tab 2: PDF Upload ---
-with tab2:
-    # ... (remains same) ...
-    st.header("📤 Manage PDF Files"); pdf_dir = st.session_state.pdf_dir
+def file_table(directory, pattern, prefix, empty_msg):
+    """One st.data_editor for a directory's files (O(1) widgets regardless of file count) plus a batch delete button."""
+    rows=list_files(directory, pattern, with_sizes=True)
+    if not rows: st.info(empty_msg); return
+    st.write(f"{len(rows)} file(s):")
+    df=pd.DataFrame({"File": [p.name for p, _ in rows], "Size (KB)": [round(n / 1024, 1) for _, n in rows], "Delete": False})
+    # Versioned key: bumping it after a delete drops stale row selections (row indices shift once files go).
+    ver_key=f"{prefix}_editor_ver"; editor_key=f"{prefix}_editor_{st.session_state.get(ver_key, 0)}"
+    edited=st.data_editor(df, key=editor_key, disabled=["File", "Size (KB)"], hide_index=True)
+    n_sel=int(edited["Delete"].sum())
+    st.button(f"🗑️ Delete selected ({n_sel})", key=f"{prefix}_delete", disabled=n_sel == 0, on_click=delete_selected, args=(editor_key, ver_key, [str(p) for p, _ in rows]))
+
+@st.fragment
+def pdf_manager(pdf_dir):
+    """Tab 2 body. Uploads, deletes and refreshes here rerun only this fragment, not the whole script."""
+    st.header("📤 Manage PDF Files")
     st.write(f"**Target:** `{pdf_dir}`"); st.markdown("---")
     st.subheader("Upload PDFs")
     st.file_uploader("Select PDF files:", type="pdf", accept_multiple_files=True, key="pdf_uploader", on_change=process_pdf_upload)
     st.markdown("---"); st.subheader("Existing PDFs")
-    if st.button("🔄 Refresh", key="refresh_pdfs"): pass
-    pdf_files = list_files(pdf_dir, "*.pdf")
-    if not pdf_files: st.info(f"No PDFs found in `{pdf_dir}`.")
-    else:
-        st.write(f"{len(pdf_files)} PDF(s):")
-        for i, f_obj in enumerate(pdf_files):
-            c1, c2 = st.columns([5, 1])
-            with c1: st.markdown(f"📄 `{f_obj.name}`", unsafe_allow_html=False)
-            with c2:
-                if st.button("🗑️", key=f"del_pdf_{i}_{f_obj.name}", help=f"Delete {f_obj.name}"): delete_file(str(f_obj))
-            st.divider()
+    st.button("🔄 Refresh", key="refresh_pdfs", on_click=_scan_dir.clear)
+    file_table(pdf_dir, "*.pdf", "pdf", f"No PDFs found in `{pdf_dir}`.")
+with tab2: pdf_manager(paths.pdf_dir)
 
 
 # --- Tab 3: Plaintext Upload ---
-with tab3:
-    # ... (remains same) ...
-    st.header("📝 Manage Plaintext Files"); txt_dir = st.session_state.txt_dir
+@st.fragment
+def txt_manager(txt_dir):
+    """Tab 3 body; fragment-scoped reruns like pdf_manager."""
+    st.header("📝 Manage Plaintext Files")
     parsed_sub = DEFAULT_PARSED_PDF_OUTPUT_SUBDIR
     st.write(f"**Target:** `{txt_dir}`"); st.caption(f"Note: Subfolder (`{parsed_sub}`) managed automatically.")
     st.markdown("---")
@@ -389,22 +1131,10 @@ with tab3:
     types = ["txt", "md", "markdown", "json", "xml", "yaml", "yml", "py", "js", "html", "css", "csv", "tsv", "rst"]
     st.file_uploader(f"Select files ({', '.join(types)}):", type=types, accept_multiple_files=True, key="txt_uploader", on_change=process_txt_upload)
     st.markdown("---"); st.subheader("Existing Files (excluding parsed subfolder)")
-    if st.button("🔄 Refresh", key="refresh_txts"): pass
-    all_f = list_files(txt_dir, "*.*"); parsed_p = Path(txt_dir) / parsed_sub
-    txt_disp = [];
-    for f in all_f:
-        try: f.relative_to(parsed_p)
-        except ValueError: txt_disp.append(f)
-        except Exception: pass
-    if not txt_disp: st.info(f"No user-added files found directly in `{txt_dir}`.")
-    else:
-        st.write(f"{len(txt_disp)} file(s):")
-        for i, f_obj in enumerate(txt_disp):
-            c1, c2 = st.columns([5, 1])
-            with c1: st.markdown(f"📄 `{f_obj.name}`", unsafe_allow_html=False)
-            with c2:
-                if st.button("🗑️", key=f"del_txt_{i}_{f_obj.name}", help=f"Delete {f_obj.name}"): delete_file(str(f_obj))
-            st.divider()
+    st.button("🔄 Refresh", key="refresh_txts", on_click=_scan_dir.clear)
+    # Single-level scan of files only, so the parsed subfolder (a dir) is never included; "*" keeps extensionless files.
+    file_table(txt_dir, "*", "txt", f"No user-added files found directly in `{txt_dir}`.")
+with tab3: txt_manager(paths.txt_dir)
 
 
 # --- Footer ---